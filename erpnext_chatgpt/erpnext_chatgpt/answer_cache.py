@@ -0,0 +1,217 @@
+import frappe
+from frappe.utils import cint, flt, nowdate
+import hashlib
+import math
+import re
+from collections import Counter
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional
+
+SETTINGS_DOCTYPE = "OpenAI Settings"
+DEFAULT_SIMILARITY = 0.95
+ENTRY_TTL = 24 * 60 * 60  # Seconds; answers about "today" or "this month" must not outlive the day
+
+# Possessives are deliberately not stopwords: "my open tasks" differs per user
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "for", "to", "in", "on", "at", "by",
+    "and", "or", "me", "us", "i", "please", "can", "could", "would", "show", "tell", "give", "list", "what", "whats",
+    "which", "how", "much", "many", "do", "does", "have", "has", "there", "all", "any", "with", "from", "it",
+    "get", "see", "find", "fetch", "display", "view",
+}
+# Words that change the meaning of a question while barely changing its trigrams:
+# time periods, negations, states and directions. They must match exactly.
+QUALIFIERS = {
+    "this", "last", "next", "previous", "current", "today", "yesterday", "tomorrow",
+    "day", "days", "week", "weeks", "month", "months", "quarter", "quarters", "year", "years",
+    "daily", "weekly", "monthly", "quarterly", "yearly", "annual", "ytd", "mtd",
+    "not", "no", "without", "never", "except", "excluding", "only",
+    "paid", "unpaid", "open", "closed", "overdue", "pending", "cancelled", "draft", "submitted", "return",
+    "asc", "ascending", "desc", "descending", "top", "bottom", "highest", "lowest", "most", "least",
+    "above", "below", "over", "under", "more", "less", "greater", "fewer", "before", "after", "since",
+    "first", "latest", "oldest", "newest", "min", "max", "minimum", "maximum",
+}
+# Spelling variants that mean the same thing; every other differing word is a different question
+SYNONYMS = {
+    "qty": "quantity",
+    "amt": "amount",
+    "inv": "invoice",
+    "bill": "invoice",
+    "client": "customer",
+    "vendor": "supplier",
+    "inventory": "stock",
+}
+# Possessives make a question personal, so its answer is never shared
+PERSONAL_WORDS = {"my", "mine", "our", "ours"}
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def is_enabled() -> bool:
+    return bool(cint(frappe.db.get_single_value(SETTINGS_DOCTYPE, "enable_answer_cache")))
+
+
+def _canonical(token: str) -> str:
+    """Map a token to its canonical form, so plurals and common synonyms compare equal."""
+    token = SYNONYMS.get(token, token)
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss") and token not in QUALIFIERS:
+        token = token[:-1]
+    return SYNONYMS.get(token, token)
+
+
+def normalise_question(question: str) -> str:
+    """Lowercase the question, drop punctuation and filler words and canonicalise the rest."""
+    tokens = TOKEN_PATTERN.findall(question.lower())
+    return " ".join(_canonical(token) for token in tokens if token not in STOPWORDS)
+
+
+def _entities(question: str) -> List[str]:
+    """
+    Tokens that name specific records, such as item codes, numbers and proper nouns, and
+    qualifiers such as periods, negations and sort directions.
+    Questions that differ in these are never treated as the same question.
+    """
+    words = re.findall(r"[\w-]+", question)
+    entities = {
+        word.lower()
+        for i, word in enumerate(words)
+        if any(c.isdigit() for c in word) or (i > 0 and not word.islower())
+    }
+    entities.update(
+        token
+        for token in TOKEN_PATTERN.findall(question.lower())
+        if token in QUALIFIERS or (token.startswith(("un", "non")) and len(token) > 4)
+    )
+    return sorted(entities)
+
+
+def is_personal(question: str) -> bool:
+    """Whether the question refers to the asking user, e.g. "my open tasks"."""
+    return any(token in PERSONAL_WORDS for token in TOKEN_PATTERN.findall(question.lower()))
+
+
+def _vector(normalised: str) -> Dict[str, int]:
+    """Character trigram counts of the normalised question."""
+    padded = f"  {normalised} "
+    return dict(Counter(padded[i : i + 3] for i in range(len(padded) - 2)))
+
+
+def similarity(a: Dict[str, int], b: Dict[str, int]) -> float:
+    """Cosine similarity of two trigram vectors."""
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    norm = math.sqrt(sum(c * c for c in a.values())) * math.sqrt(sum(c * c for c in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def _token_key(normalised: str) -> str:
+    """Questions can only match if they use the same words, so entries are keyed by their word set."""
+    return hashlib.sha1(" ".join(sorted(set(normalised.split()))).encode()).hexdigest()
+
+
+def is_same_question(question: str, other: str, threshold: float = DEFAULT_SIMILARITY) -> bool:
+    """
+    Whether two questions can share an answer. They must use the same words once filler words,
+    plurals and synonyms are accounted for, and name the same records and qualifiers. Trigram
+    similarity then rejects questions whose word order changes their meaning.
+    """
+    normalised, other_normalised = normalise_question(question), normalise_question(other)
+    if not normalised or set(normalised.split()) != set(other_normalised.split()):
+        return False
+    if _entities(question) != _entities(other):
+        return False
+    return normalised == other_normalised or similarity(_vector(normalised), _vector(other_normalised)) >= threshold
+
+
+def _key(*parts: str) -> str:
+    return ":".join(("openai_answer_cache",) + parts)
+
+
+def _scope(per_user: bool = False) -> str:
+    """
+    Shared answers are only shared between users with the same roles and user permissions.
+    Answers that depend on who is asking (owner-only permissions, shared documents, user
+    defaults or "my" questions) are kept per user. The date is included because questions
+    are often relative to today.
+    """
+    user = frappe.session.user
+    fingerprint = repr(
+        (
+            sorted(frappe.get_roles(user)),
+            sorted(frappe.permissions.get_user_permissions(user).items()),
+            user if per_user else None,
+            nowdate(),
+        )
+    )
+    return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+
+def get_data_versions(doctypes: Iterable[str]) -> Dict[str, int]:
+    """Get the current data version watermark of each DocType."""
+    doctypes = sorted(set(doctypes))
+    if not doctypes:
+        return {}
+    cache = frappe.cache()
+    versions = cache.mget([cache.make_key(_key("version", doctype)) for doctype in doctypes])
+    return {doctype: cint(version) for doctype, version in zip(doctypes, versions)}
+
+
+def _bump(doctype: str) -> None:
+    cache = frappe.cache()
+    cache.incr(cache.make_key(_key("version", doctype)))
+
+
+def bump_data_version(doc, method=None) -> None:
+    """
+    Document event hook: invalidate cached answers that read this DocType.
+
+    The version is bumped right away, so existing answers stop being served, and again after
+    commit, so an answer built from a read of the uncommitted change is not cached as current.
+    """
+    _bump(doc.doctype)
+    frappe.db.after_commit.add(partial(_bump, doc.doctype))
+
+
+def get_cached_answer(question: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up an answer to the same question whose data has not changed since.
+
+    :param question: The user's question.
+    :return: The cached assistant message, or None.
+    """
+    normalised = normalise_question(question)
+    if not normalised:
+        return None
+    threshold = flt(frappe.db.get_single_value(SETTINGS_DOCTYPE, "answer_cache_similarity")) or DEFAULT_SIMILARITY
+    scopes = [_scope(per_user=True)] if is_personal(question) else [_scope(per_user=True), _scope()]
+    token_key = _token_key(normalised)
+
+    cache = frappe.cache()
+    for entry_key in (_key("entry", scope, token_key) for scope in scopes):
+        entry = cache.get_value(entry_key)
+        if not entry or not is_same_question(question, entry["question"], threshold):
+            continue
+        if get_data_versions(entry["versions"]) != entry["versions"]:
+            cache.delete_value(entry_key)
+            continue
+        return entry["answer"]
+    return None
+
+
+def set_cached_answer(
+    question: str, answer: Dict[str, Any], versions: Dict[str, int], per_user: bool = False
+) -> None:
+    """
+    Cache an answer along with the data versions of the DocTypes it was built from.
+
+    :param question: The user's question.
+    :param answer: The assistant message returned to the user.
+    :param versions: Data versions taken before the tools ran, see `get_data_versions`.
+    :param per_user: Whether the answer depends on the asking user and must not be shared.
+    """
+    normalised = normalise_question(question)
+    if not normalised:
+        return
+    scope = _scope(per_user or is_personal(question))
+    frappe.cache().set_value(
+        _key("entry", scope, _token_key(normalised)),
+        {"question": question, "versions": versions, "answer": answer},
+        expires_in_sec=ENTRY_TTL,
+    )
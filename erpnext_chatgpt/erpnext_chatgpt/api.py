@@ -1,14 +1,33 @@
 import frappe
 from frappe import _
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
 import json
 from typing import List, Dict, Any
-from erpnext_chatgpt.erpnext_chatgpt.tools import get_tools, available_functions
+from erpnext_chatgpt.erpnext_chatgpt.tools import get_tools, available_functions, get_tool_doctypes, user_dependent_tools
+from erpnext_chatgpt.erpnext_chatgpt import answer_cache
+from erpnext_chatgpt.erpnext_chatgpt.deadline import (
+    OPENAI_MAX_RETRIES,
+    QueryTooExpensiveError,
+    check_request_deadline,
+    end_request,
+    openai_attempt_timeout,
+    start_request,
+    tool_deadline,
+)
+from erpnext_chatgpt.erpnext_chatgpt.quota import (
+    QuotaExceededError,
+    check_quota,
+    get_limits,
+    get_usage,
+    record_request,
+    record_usage,
+)
 
 # Define a pre-prompt to set the context or provide specific instructions
 PRE_PROMPT = f"You are an AI assistant integrated with ERPNext. Please provide accurate and helpful responses based on the following questions and data provided by the user. The current date is {frappe.utils.now()}."
 MODEL = "gpt-4o-mini"  # Updated to the latest GPT-4 model
 MAX_TOKENS = 8000  # Set a maximum token limit
+PROVIDER_RETRY_AFTER = 20  # Seconds to back off when OpenAI itself rate limits us
 
 def get_openai_client() -> OpenAI:
     """Get the OpenAI client with the API key from settings."""
@@ -20,6 +39,7 @@ def get_openai_client() -> OpenAI:
 def handle_tool_calls(tool_calls: List[Any], conversation: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Handle the tool calls by executing the corresponding functions and appending the results to the conversation."""
     for tool_call in tool_calls:
+        check_request_deadline()
         function_name = tool_call.function.name
         function_to_call = available_functions.get(function_name)
         if not function_to_call:
@@ -28,7 +48,12 @@ def handle_tool_calls(tool_calls: List[Any], conversation: List[Dict[str, Any]])
 
         function_args = json.loads(tool_call.function.arguments)
         try:
-            function_response = function_to_call(**function_args)
+            with tool_deadline(function_name):
+                function_response = function_to_call(**function_args)
+        except QueryTooExpensiveError as e:
+            # Let the model narrow its filters instead of failing the whole request
+            frappe.log_error(f"Query too expensive in {function_name} with args {json.dumps(function_args)}", "OpenAI Tool Timeout")
+            function_response = json.dumps(e.as_tool_response())
         except Exception as e:
             frappe.log_error(f"Error calling function {function_name} with args {json.dumps(function_args)}: {str(e)}", "OpenAI Tool Error")
             raise
@@ -65,6 +90,36 @@ def trim_conversation_to_token_limit(conversation: List[Dict[str, Any]], token_l
                 break
     return conversation
 
+def get_cacheable_question(conversation: List[Dict[str, Any]]) -> str:
+    """
+    Get the question if it can be answered from the answer cache.
+    Only opening questions qualify, as follow-ups depend on the earlier conversation.
+    """
+    messages = [message for message in conversation if message.get("role") != "system"]
+    if len(messages) != 1 or messages[0].get("role") != "user":
+        return ""
+    content = messages[0].get("content")
+    return content if isinstance(content, str) else ""
+
+def has_tool_error(conversation: List[Dict[str, Any]]) -> bool:
+    """Check whether any tool returned an error, in which case the answer should not be cached."""
+    return any(
+        message.get("role") == "tool" and str(message.get("content", "")).startswith('{"error"')
+        for message in conversation
+    )
+
+def cache_answer(question: str, answer: Dict[str, Any], data_versions: Dict[str, int], per_user: bool) -> None:
+    """Store an answer in the answer cache without letting cache errors fail the request."""
+    try:
+        answer_cache.set_cached_answer(question, answer, data_versions, per_user)
+    except Exception as e:
+        frappe.log_error(str(e), "OpenAI Answer Cache Error")
+
+def too_many_requests(message: str, retry_after: int) -> Dict[str, Any]:
+    """Build a 429 response telling the client when it may retry."""
+    frappe.local.response["http_status_code"] = 429
+    return {"error": message, "retry_after": retry_after}
+
 @frappe.whitelist()
 def ask_openai_question(conversation: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
@@ -73,8 +128,23 @@ def ask_openai_question(conversation: List[Dict[str, Any]]) -> Dict[str, Any]:
     :param conversation: List of conversation messages.
     :return: The response from OpenAI or an error message.
     """
+    question = get_cacheable_question(conversation)
+    use_answer_cache = False
     try:
-        client = get_openai_client()
+        use_answer_cache = bool(question) and answer_cache.is_enabled()
+        cached_answer = answer_cache.get_cached_answer(question) if use_answer_cache else None
+        if cached_answer:
+            return {**cached_answer, "cached": True}
+    except Exception as e:
+        # The cache is an optimisation, carry on without it
+        frappe.log_error(str(e), "OpenAI Answer Cache Error")
+
+    start_request()
+    try:
+        check_quota()
+        # Each attempt's timeout is capped so all retries fit in the request deadline
+        client = get_openai_client().with_options(max_retries=OPENAI_MAX_RETRIES)
+        record_request()
 
         # Add the pre-prompt as the initial message if not present
         if not conversation or conversation[0].get("role") != "system":
@@ -90,31 +160,71 @@ def ask_openai_question(conversation: List[Dict[str, Any]]) -> Dict[str, Any]:
             model=MODEL,
             messages=conversation,
             tools=tools,
-            tool_choice="auto"
+            tool_choice="auto",
+            timeout=openai_attempt_timeout()
         )
+        record_usage(response.usage)
 
         response_message = response.choices[0].message
 
         frappe.logger("OpenAI").debug(f"OpenAI Response: {response_message}")
 
         tool_calls = response_message.tool_calls
+        data_versions = {}
+        per_user = False
         if tool_calls:
+            per_user = any(tool_call.function.name in user_dependent_tools for tool_call in tool_calls)
+            # Take the watermarks before the tools run, so changes made meanwhile invalidate the answer
+            data_versions = answer_cache.get_data_versions(
+                doctype
+                for tool_call in tool_calls
+                for doctype in get_tool_doctypes(tool_call.function.name, json.loads(tool_call.function.arguments))
+            )
             conversation.append(response_message.model_dump())
             conversation = handle_tool_calls(tool_calls, conversation)
 
             # Trim again if needed after tool calls
             conversation = trim_conversation_to_token_limit(conversation)
 
+            check_request_deadline()
             second_response = client.chat.completions.create(
                 model=MODEL,
-                messages=conversation
+                messages=conversation,
+                timeout=openai_attempt_timeout()
             )
-            return second_response.choices[0].message.model_dump()
+            record_usage(second_response.usage)
+            answer = second_response.choices[0].message.model_dump()
+            if use_answer_cache and not has_tool_error(conversation):
+                cache_answer(question, answer, data_versions, per_user)
+            return answer
 
-        return response_message.model_dump()
+        answer = response_message.model_dump()
+        if use_answer_cache:
+            cache_answer(question, answer, data_versions, per_user)
+        return answer
+    except QuotaExceededError as e:
+        return too_many_requests(str(e), e.retry_after)
+    except RateLimitError as e:
+        frappe.log_error(str(e), "OpenAI Rate Limit")
+        return too_many_requests(_("OpenAI is busy right now. Please try again shortly."), PROVIDER_RETRY_AFTER)
     except Exception as e:
         frappe.log_error(str(e), "OpenAI API Error")
         return {"error": str(e)}
+    finally:
+        end_request()
+
+@frappe.whitelist()
+def get_usage_report(date: str = None) -> Dict[str, Any]:
+    """
+    Get the OpenAI request and token usage for a day. Only available to System Managers.
+
+    :param date: The date in YYYY-MM-DD format, defaults to today.
+    :return: Dictionary with the site totals, the per user usage and the configured limits.
+    """
+    frappe.only_for("System Manager")
+    report = get_usage(date)
+    report["limits"] = get_limits()
+    return report
 
 @frappe.whitelist()
 def test_openai_api_key(api_key: str) -> bool:
@@ -0,0 +1,146 @@
+import frappe
+from frappe import _
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+REQUEST_TIMEOUT = 60  # Seconds a whole chat request may take, including OpenAI calls and tools
+DEFAULT_TOOL_TIMEOUT = 10  # Seconds the queries of a single tool call may take
+TOOL_TIMEOUTS = {
+    "get_general_ledger_entries": 15,
+    "get_balance_sheet": 15,
+}
+MIN_STATEMENT_TIME = 0.1  # Don't start a query with less time than this left
+OPENAI_MAX_RETRIES = 2  # Retries of transient OpenAI errors, all within the request deadline
+OPENAI_BACKOFF_ALLOWANCE = 3  # Seconds kept free for the client's backoff between retries
+ER_STATEMENT_TIMEOUT = 1969  # MariaDB: max_statement_time exceeded
+
+
+class RequestDeadlineExceededError(frappe.ValidationError):
+    """Raised when the chat request has run out of time."""
+
+    def __init__(self):
+        super().__init__(_("The request took too long. Please ask a more specific question."))
+
+
+class QueryTooExpensiveError(frappe.ValidationError):
+    """Raised when a tool query is aborted for exceeding its time budget."""
+
+    def __init__(self, tool: Optional[str], timeout: float):
+        super().__init__(_("The query took longer than {0} seconds and was cancelled.").format(round(timeout, 1)))
+        self.tool = tool
+        self.timeout = timeout
+
+    def as_tool_response(self) -> Dict[str, Any]:
+        """The structured error returned to the model instead of the tool result."""
+        return {
+            "error": "query_too_expensive",
+            "message": str(self),
+            "hint": "Narrow the filters, e.g. a shorter date range or a specific party or account, "
+            "instead of repeating the same call.",
+        }
+
+
+def start_request(timeout: float = REQUEST_TIMEOUT) -> None:
+    """Start the deadline of the current chat request."""
+    frappe.local.openai_request_deadline = time.monotonic() + timeout
+
+
+def end_request() -> None:
+    frappe.local.openai_request_deadline = None
+
+
+def request_time_left() -> Optional[float]:
+    """Seconds left before the request deadline, or None if no request is running."""
+    deadline = getattr(frappe.local, "openai_request_deadline", None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def openai_attempt_timeout() -> Optional[float]:
+    """
+    Timeout for each attempt of an OpenAI call, so that the first try and all its retries,
+    including backoff, fit in the time left for the request.
+    """
+    time_left = request_time_left()
+    if time_left is None:
+        return None
+    check_request_deadline()
+    attempts = OPENAI_MAX_RETRIES + 1
+    return max(MIN_STATEMENT_TIME, (time_left - OPENAI_BACKOFF_ALLOWANCE) / attempts)
+
+
+def check_request_deadline() -> None:
+    """
+    Stop work on a request that has run out of time.
+
+    :raises RequestDeadlineExceededError: If the request deadline has passed.
+    """
+    time_left = request_time_left()
+    if time_left is not None and time_left <= 0:
+        raise RequestDeadlineExceededError()
+
+
+@contextmanager
+def tool_deadline(tool: str) -> Iterator[None]:
+    """Give the queries run inside the block the time budget of a tool."""
+    previous = getattr(frappe.local, "openai_tool_deadline", None)
+    timeout = TOOL_TIMEOUTS.get(tool, DEFAULT_TOOL_TIMEOUT)
+    frappe.local.openai_tool_deadline = (tool, time.monotonic() + timeout, timeout)
+    try:
+        yield
+    finally:
+        frappe.local.openai_tool_deadline = previous
+
+
+def _statement_budget() -> Dict[str, Any]:
+    """Work out how long the next statement may run and what limits it."""
+    tool, tool_deadline_at, tool_timeout = getattr(frappe.local, "openai_tool_deadline", None) or (
+        None,
+        None,
+        DEFAULT_TOOL_TIMEOUT,
+    )
+    time_left = tool_timeout if tool_deadline_at is None else tool_deadline_at - time.monotonic()
+    request_left = request_time_left()
+    limited_by_request = request_left is not None and request_left < time_left
+    return {
+        "tool": tool,
+        "tool_timeout": tool_timeout,
+        "time_left": request_left if limited_by_request else time_left,
+        "limited_by_request": limited_by_request,
+    }
+
+
+def _is_statement_timeout(e: Exception) -> bool:
+    """
+    Only max_statement_time aborts count; lock wait timeouts are not a sign of an expensive query.
+    Frappe may wrap the driver error, so the cause and wrapped error are checked too.
+    """
+    errors = [e, e.__cause__] + [arg for arg in e.args if isinstance(arg, Exception)]
+    return any(err is not None and err.args and err.args[0] == ER_STATEMENT_TIMEOUT for err in errors)
+
+
+def run_sql(query: str, values: Any = (), **kwargs) -> Any:
+    """
+    Run a tool query with a statement timeout bound by the tool and request deadlines.
+
+    :raises QueryTooExpensiveError: If the query runs out of its tool time budget.
+    :raises RequestDeadlineExceededError: If the request runs out of time.
+    """
+    budget = _statement_budget()
+    if budget["time_left"] < MIN_STATEMENT_TIME:
+        if budget["limited_by_request"]:
+            raise RequestDeadlineExceededError()
+        raise QueryTooExpensiveError(budget["tool"], budget["tool_timeout"])
+
+    if frappe.db.db_type == "mariadb":
+        query = f"SET STATEMENT max_statement_time={budget['time_left']:.3f} FOR {query}"
+    try:
+        return frappe.db.sql(query, values, **kwargs)
+    except Exception as e:
+        if not _is_statement_timeout(e):
+            raise
+        if budget["limited_by_request"]:
+            raise RequestDeadlineExceededError() from e
+        raise QueryTooExpensiveError(budget["tool"], budget["tool_timeout"]) from e
@@ -16,5 +16,46 @@ frappe.ui.form.on("OpenAI Settings", {
         },
       });
     });
+
+    frm.add_custom_button(__("Usage Report"), function () {
+      frappe.call({
+        method: "erpnext_chatgpt.erpnext_chatgpt.api.get_usage_report",
+        callback: function (r) {
+          if (!r.message) return;
+          const report = r.message;
+          const rows = [{ user: __("Site"), ...report.site }]
+            .concat(report.users)
+            .map(
+              (row) => `
+                <tr>
+                  <td>${frappe.utils.escape_html(row.user)}</td>
+                  <td>${row.requests || 0}</td>
+                  <td>${row.prompt_tokens || 0}</td>
+                  <td>${row.completion_tokens || 0}</td>
+                  <td>${row.total_tokens || 0}</td>
+                </tr>`
+            )
+            .join("");
+          frappe.msgprint({
+            title: __("OpenAI Usage for {0}", [report.date]),
+            wide: true,
+            message: `
+              <table class="table table-bordered">
+                <thead>
+                  <tr>
+                    <th>${__("User")}</th>
+                    <th>${__("Requests")}</th>
+                    <th>${__("Prompt Tokens")}</th>
+                    <th>${__("Completion Tokens")}</th>
+                    <th>${__("Total Tokens")}</th>
+                  </tr>
+                </thead>
+                <tbody>${rows}</tbody>
+              </table>
+            `,
+          });
+        },
+      });
+    });
   },
 });
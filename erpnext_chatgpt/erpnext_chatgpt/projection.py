@@ -0,0 +1,153 @@
+import frappe
+from frappe import _
+from frappe.model import table_fields
+from frappe.utils import flt
+from erpnext_chatgpt.erpnext_chatgpt.deadline import run_sql
+from erpnext_chatgpt.erpnext_chatgpt.query import NUMERIC_FIELDTYPES, get_metadata_version
+from typing import Any, Dict, List, Optional, Tuple
+
+MAX_CHILD_ROWS = 100
+ALWAYS_INCLUDE = ("name", "docstatus", "status")
+IGNORED_FIELDS = {"naming_series", "amended_from"}
+LINK_FIELDTYPES = ("Link", "Dynamic Link")
+# Links that only affect printing or layout, not the business meaning of a document
+IGNORED_LINK_OPTIONS = {"Letter Head", "Print Heading", "Print Format", "Address Template", "Terms and Conditions"}
+
+# Field plans keyed by site and DocType, with the metadata and schema version they were built for.
+# A plan for a newer version replaces the old one, so the cache only grows with the DocTypes used.
+_plan_cache: Dict[Tuple[str, str], Tuple[Tuple[Optional[str], str], Dict[str, Any]]] = {}
+
+
+def _is_relevant(df) -> bool:
+    """Whether a field is worth showing to the model."""
+    if df.hidden or df.fieldtype in table_fields or df.fieldname in IGNORED_FIELDS:
+        return False
+    if df.fieldtype in LINK_FIELDTYPES:
+        return df.options not in IGNORED_LINK_OPTIONS
+    return bool(df.in_list_view or df.in_standard_filter or df.reqd or df.fieldtype == "Currency")
+
+
+def get_field_plan(doctype: str) -> Dict[str, Any]:
+    """
+    Get the business relevant fields of a DocType and of its child tables.
+
+    :param doctype: The DocType to plan for.
+    :return: Dictionary with `fields`, `defaults`, `numeric` and `currency` fields and the `tables`
+        to include, keyed by table fieldname.
+    """
+    meta = frappe.get_meta(doctype)
+    # The metadata version changes with Custom Fields and Property Setters, meta.modified does not
+    cache_key = (frappe.local.site, doctype)
+    version = (get_metadata_version(), str(meta.modified))
+    cached = _plan_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    columns = set(meta.get_valid_columns())
+    fields = [fieldname for fieldname in ALWAYS_INCLUDE if fieldname in columns]
+    if meta.title_field in columns and meta.title_field not in fields:
+        fields.append(meta.title_field)
+    fields.extend(
+        df.fieldname for df in meta.fields if df.fieldname in columns and df.fieldname not in fields and _is_relevant(df)
+    )
+
+    tables = {}
+    for df in meta.get_table_fields():
+        if df.hidden:
+            continue
+        # Child rows are kept to the grid columns and amounts
+        child_meta = frappe.get_meta(df.options)
+        child_columns = set(child_meta.get_valid_columns())
+        child_fields = [
+            child_df.fieldname
+            for child_df in child_meta.fields
+            if child_df.fieldname in child_columns
+            and not child_df.hidden
+            and (child_df.in_list_view or child_df.fieldtype == "Currency")
+        ]
+        if child_fields:
+            tables[df.fieldname] = {
+                "doctype": df.options,
+                "fields": child_fields,
+                "defaults": {d.fieldname: d.default for d in child_meta.fields if d.default is not None},
+                "numeric": {d.fieldname for d in child_meta.fields if d.fieldtype in NUMERIC_FIELDTYPES},
+                "currency": {d.fieldname for d in child_meta.fields if d.fieldtype == "Currency"},
+            }
+
+    plan = {
+        "fields": fields,
+        "defaults": {df.fieldname: df.default for df in meta.fields if df.default is not None},
+        "numeric": {df.fieldname for df in meta.fields if df.fieldtype in NUMERIC_FIELDTYPES},
+        "currency": {df.fieldname for df in meta.fields if df.fieldtype == "Currency"},
+        "tables": tables,
+    }
+    _plan_cache[cache_key] = (version, plan)
+    return plan
+
+
+def _is_empty(value: Any, default: Optional[str], numeric: bool = False, currency: bool = False) -> bool:
+    """
+    Whether a value carries no information: unset, its default, or a zero count or rate.
+    A zero amount is kept unless it is the field's default, since an outstanding amount of 0
+    is an answer in itself.
+    """
+    if value is None or value == "":
+        return True
+    if numeric:
+        return (not currency and flt(value) == 0) or (default is not None and flt(value) == flt(default))
+    return default is not None and str(value) == str(default)
+
+
+def _compact_rows(rows: List[Dict[str, Any]], table: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn child rows into column names plus value lists, leaving out columns that are empty in every row."""
+    columns = [
+        f
+        for f in table["fields"]
+        if any(
+            not _is_empty(row.get(f), table["defaults"].get(f), f in table["numeric"], f in table["currency"])
+            for row in rows
+        )
+    ]
+    return {"columns": columns, "rows": [[row.get(f) for f in columns] for row in rows]}
+
+
+def summarise_document(doctype: str, name: str) -> Optional[Dict[str, Any]]:
+    """
+    Get a compact summary of a document: its business relevant fields without empty or default
+    values, and its child tables as compact rows.
+
+    :param doctype: The DocType of the document.
+    :param name: The name of the document.
+    :return: The summary, or None if the document does not exist.
+    """
+    plan = get_field_plan(doctype)
+    columns = ", ".join(f"`{fieldname}`" for fieldname in plan["fields"])
+    rows = run_sql(f"SELECT {columns} FROM `tab{doctype}` WHERE name = %s", (name,), as_dict=True)
+    if not rows:
+        return None
+
+    summary = {
+        fieldname: value
+        for fieldname, value in rows[0].items()
+        if fieldname in ALWAYS_INCLUDE
+        or not _is_empty(
+            value, plan["defaults"].get(fieldname), fieldname in plan["numeric"], fieldname in plan["currency"]
+        )
+    }
+
+    for table_fieldname, table in plan["tables"].items():
+        child_columns = ", ".join(f"`{fieldname}`" for fieldname in table["fields"])
+        child_rows = run_sql(
+            f"""SELECT {child_columns} FROM `tab{table['doctype']}`
+            WHERE parent = %s AND parenttype = %s AND parentfield = %s
+            ORDER BY idx LIMIT {MAX_CHILD_ROWS + 1}""",
+            (name, doctype, table_fieldname),
+            as_dict=True,
+        )
+        if not child_rows:
+            continue
+        summary[table_fieldname] = _compact_rows(child_rows[:MAX_CHILD_ROWS], table)
+        if len(child_rows) > MAX_CHILD_ROWS:
+            summary[table_fieldname]["truncated"] = _("Only the first {0} rows are shown.").format(MAX_CHILD_ROWS)
+
+    return summary
@@ -0,0 +1,320 @@
+import frappe
+from frappe import _
+from frappe.model import no_value_fields, table_fields
+from frappe.model.db_query import DatabaseQuery
+from frappe.query_builder import DocType, Order
+from frappe.query_builder.functions import Avg, Count, Max, Min, Sum
+from frappe.utils import cint
+from erpnext_chatgpt.erpnext_chatgpt.deadline import (
+    QueryTooExpensiveError,
+    RequestDeadlineExceededError,
+    run_sql,
+)
+from pypika.terms import Parameter, PseudoColumn
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_ROW_LIMIT = 100
+MAX_ROW_LIMIT = 500
+MAX_IN_VALUES = 100
+PLAN_CACHE_SIZE = 256
+
+AGGREGATES = {"count": Count, "sum": Sum, "avg": Avg, "min": Min, "max": Max}
+AGGREGATE_PATTERN = re.compile(r"^\s*(count|sum|avg|min|max)\s*\(\s*(\*|\w+)\s*\)\s*$", re.IGNORECASE)
+OPERATORS = {"=", "!=", ">", ">=", "<", "<=", "like", "not like", "in", "not in", "between", "is"}
+NUMERIC_FIELDTYPES = {"Int", "Float", "Currency", "Percent", "Duration", "Check"}
+SCALAR_TYPES = (str, int, float, bool)
+STANDARD_FIELDS = {
+    "name": "Data",
+    "owner": "Link",
+    "creation": "Datetime",
+    "modified": "Datetime",
+    "modified_by": "Link",
+    "docstatus": "Int",
+}
+
+# Compiled plans keyed by site, user, roles, metadata version, row permissions and query shape
+_plan_cache: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+class QueryValidationError(frappe.ValidationError):
+    """Raised when a generated query does not match the DocType or the user's permissions."""
+
+
+def get_queryable_fields(doctype: str) -> Dict[str, str]:
+    """
+    Get the fields of a DocType the current user may read, mapped to their fieldtype.
+
+    :param doctype: The DocType to inspect.
+    :return: Dictionary of fieldname to fieldtype.
+    """
+    meta = frappe.get_meta(doctype)
+    readable_levels = set(meta.get_permlevel_access("read") or [0])
+    fields = dict(STANDARD_FIELDS)
+    for df in meta.fields:
+        if df.fieldtype in no_value_fields or df.fieldtype in table_fields or df.fieldtype == "Password":
+            continue
+        if df.get("is_virtual"):
+            # Virtual fields are computed in Python and have no column to select
+            continue
+        if df.permlevel not in readable_levels:
+            continue
+        fields[df.fieldname] = df.fieldtype
+    return fields
+
+
+def get_metadata_version() -> Optional[str]:
+    """
+    Frappe resets this whenever a DocType's cache is cleared, including for Custom Fields,
+    Property Setters and permission changes, so it invalidates plans on every worker.
+    """
+    return frappe.cache().get_value("metadata_version")
+
+
+def _shape(fields, filters, group_by, order_by, limit) -> Tuple:
+    """
+    The cache key of a query: everything except the filter values bound as parameters.
+    The value of `is` filters is compiled into the SQL, so it is part of the shape.
+    """
+    filter_shape = []
+    for f in filters:
+        operator = str(f.get("operator", "=")).lower()
+        value = f.get("value")
+        detail = value if operator == "is" else len(value) if isinstance(value, list) else None
+        filter_shape.append((str(f.get("field")), operator, detail))
+    return (tuple(fields), tuple(filter_shape), tuple(group_by), tuple(order_by), cint(limit))
+
+
+def _parse_field(expression: str, queryable: Dict[str, str]) -> Tuple[str, Optional[str], str]:
+    """Parse a selected field into (fieldname, aggregate, alias)."""
+    match = AGGREGATE_PATTERN.match(expression)
+    if match:
+        function, fieldname = match.group(1).lower(), match.group(2)
+        if fieldname == "*":
+            if function != "count":
+                raise QueryValidationError(_("Only count can be used with *."))
+            return "name", function, "count"
+        if fieldname not in queryable:
+            raise QueryValidationError(_("Unknown or restricted field: {0}").format(fieldname))
+        if function in ("sum", "avg") and queryable[fieldname] not in NUMERIC_FIELDTYPES:
+            raise QueryValidationError(_("{0} can only be used on numeric fields, {1} is not numeric.").format(function, fieldname))
+        return fieldname, function, f"{function}_{fieldname}"
+
+    fieldname = expression.strip()
+    if fieldname not in queryable:
+        raise QueryValidationError(_("Unknown or restricted field: {0}").format(fieldname))
+    return fieldname, None, fieldname
+
+
+def _validate_filter(f: Dict[str, Any]) -> Tuple[str, Optional[int]]:
+    """
+    Check the operator and value of a filter. This runs on every call, as the values
+    are not part of the cached plan.
+
+    :return: The operator and the number of parameters its value binds.
+    """
+    operator = str(f.get("operator", "=")).lower()
+    value = f.get("value")
+    if operator not in OPERATORS:
+        raise QueryValidationError(_("Unsupported operator: {0}").format(operator))
+
+    if operator in ("in", "not in"):
+        if not isinstance(value, list) or not value or len(value) > MAX_IN_VALUES:
+            raise QueryValidationError(_("{0} needs a list of 1 to {1} values.").format(operator, MAX_IN_VALUES))
+        count = len(value)
+    elif operator == "between":
+        if not isinstance(value, list) or len(value) != 2:
+            raise QueryValidationError(_("between needs a list of exactly 2 values."))
+        count = 2
+    elif operator == "is":
+        if value not in ("set", "not set"):
+            raise QueryValidationError(_("is needs the value 'set' or 'not set'."))
+        return operator, None
+    else:
+        value, count = [value], 1
+
+    if not all(isinstance(v, SCALAR_TYPES) for v in value):
+        raise QueryValidationError(_("{0} needs text, number or boolean values.").format(operator))
+    return operator, count
+
+
+def _criterion(column, operator: str, params: List[Parameter], value: Any):
+    if operator == "=":
+        return column == params[0]
+    if operator == "!=":
+        return column != params[0]
+    if operator == ">":
+        return column > params[0]
+    if operator == ">=":
+        return column >= params[0]
+    if operator == "<":
+        return column < params[0]
+    if operator == "<=":
+        return column <= params[0]
+    if operator == "like":
+        return column.like(params[0])
+    if operator == "not like":
+        return column.not_like(params[0])
+    if operator == "in":
+        return column.isin(params)
+    if operator == "not in":
+        return column.notin(params)
+    if operator == "between":
+        return column.between(params[0], params[1])
+    return column.isnotnull() & (column != "") if value == "set" else column.isnull() | (column == "")
+
+
+def compile_query(
+    doctype: str,
+    fields: List[str],
+    filters: List[Dict[str, Any]],
+    group_by: List[str],
+    order_by: List[str],
+    limit: int,
+) -> Dict[str, Any]:
+    """
+    Validate a query against the DocType metadata and the user's permissions and compile it to SQL.
+
+    The result is cached per query shape, so repeating a query with different filter values
+    skips the metadata and permission checks and compilation. Filter values are checked
+    by `run_query` on every call.
+
+    :return: Dictionary with the parameterised `sql`, see `bind_values` for its parameters.
+    """
+    if not frappe.db.exists("DocType", doctype):
+        raise QueryValidationError(_("Unknown DocType: {0}").format(doctype))
+    meta = frappe.get_meta(doctype)
+    if meta.istable or meta.issingle:
+        raise QueryValidationError(_("{0} cannot be queried directly.").format(doctype))
+    if not frappe.has_permission(doctype, "read"):
+        raise QueryValidationError(_("You do not have permission to read {0}.").format(doctype))
+
+    # Row level permissions, roles and the metadata version are part of the key,
+    # so permission and customisation changes are picked up
+    match_conditions = DatabaseQuery(doctype).build_match_conditions()
+    cache_key = (
+        frappe.local.site,
+        frappe.session.user,
+        tuple(sorted(frappe.get_roles())),
+        doctype,
+        get_metadata_version(),
+        str(meta.modified),
+        match_conditions,
+        _shape(fields, filters, group_by, order_by, limit),
+    )
+    with _plan_cache_lock:
+        plan = _plan_cache.get(cache_key)
+        if plan is not None:
+            _plan_cache.move_to_end(cache_key)
+            return plan
+
+    queryable = get_queryable_fields(doctype)
+    table = DocType(doctype)
+
+    selected = [_parse_field(expression, queryable) for expression in fields or ["name"]]
+    aliases = {alias for _f, _function, alias in selected}
+    grouped = [g.strip() for g in group_by]
+    for fieldname in grouped:
+        if fieldname not in queryable:
+            raise QueryValidationError(_("Unknown or restricted group by field: {0}").format(fieldname))
+    if grouped or any(function for _f, function, _a in selected):
+        ungrouped = [fieldname for fieldname, function, _a in selected if not function and fieldname not in grouped]
+        if ungrouped:
+            raise QueryValidationError(_("Fields must be aggregated or grouped: {0}").format(", ".join(ungrouped)))
+
+    query = frappe.qb.from_(table)
+    for fieldname, function, alias in selected:
+        column = AGGREGATES[function](table[fieldname]) if function else table[fieldname]
+        query = query.select(column.as_(alias))
+
+    param_count = 0
+    for f in filters:
+        fieldname = str(f.get("field"))
+        if fieldname not in queryable:
+            raise QueryValidationError(_("Unknown or restricted filter field: {0}").format(fieldname))
+        operator, count = _validate_filter(f)
+        placeholders = [Parameter(f"%(p{param_count + i})s") for i in range(count or 0)]
+        param_count += len(placeholders)
+        query = query.where(_criterion(table[fieldname], operator, placeholders, f.get("value")))
+
+    if match_conditions:
+        # Literal % signs must not be mistaken for parameter placeholders
+        query = query.where(PseudoColumn(f"({match_conditions.replace('%', '%%')})"))
+
+    for fieldname in grouped:
+        query = query.groupby(table[fieldname])
+
+    for expression in order_by:
+        parts = expression.strip().rsplit(None, 1)
+        direction = Order.asc
+        if len(parts) == 2 and parts[1].lower() in ("asc", "desc"):
+            expression, direction = parts[0], Order.desc if parts[1].lower() == "desc" else Order.asc
+        _f, function, alias = _parse_field(expression, queryable)
+        if alias not in aliases and (function or (grouped and alias not in grouped)):
+            raise QueryValidationError(_("Can only order by selected or grouped fields: {0}").format(expression))
+        query = query.orderby(PseudoColumn(f"`{alias}`") if alias in aliases else table[alias], order=direction)
+
+    query = query.limit(max(1, min(cint(limit) or DEFAULT_ROW_LIMIT, MAX_ROW_LIMIT)))
+
+    plan = {"sql": query.get_sql()}
+    with _plan_cache_lock:
+        _plan_cache[cache_key] = plan
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+
+def _as_list(value: Any) -> List[str]:
+    """Accept both a list and a comma separated string of field expressions."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def bind_values(filters: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Flatten the filter values into the named parameters of a compiled query."""
+    values: List[Any] = []
+    for f in filters:
+        value = f.get("value")
+        operator = str(f.get("operator", "=")).lower()
+        if operator == "is":
+            continue
+        values.extend(value if isinstance(value, list) else [value])
+    return {f"p{i}": value for i, value in enumerate(values)}
+
+
+def run_query(
+    doctype: str,
+    fields: Optional[List[str]] = None,
+    filters: Optional[List[Dict[str, Any]]] = None,
+    group_by: Optional[List[str]] = None,
+    order_by: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run a validated, read-only query with a row limit and the tool's statement timeout.
+
+    :raises QueryValidationError: If the query does not match the DocType or permissions,
+        or the database rejects it.
+    """
+    fields, group_by, order_by = _as_list(fields), _as_list(group_by), _as_list(order_by)
+    filters = filters or []
+    if not isinstance(filters, list) or not all(isinstance(f, dict) for f in filters):
+        raise QueryValidationError(_("filters must be a list of objects with field, operator and value."))
+    for f in filters:
+        _validate_filter(f)
+
+    plan = compile_query(doctype, fields, filters, group_by, order_by, limit)
+    try:
+        return run_sql(plan["sql"], bind_values(filters), as_dict=True)
+    except (QueryTooExpensiveError, RequestDeadlineExceededError):
+        raise
+    except Exception as e:
+        # Let the model correct its query instead of failing the whole chat request
+        frappe.log_error(f"query_doctype failed for {doctype}: {e}", "OpenAI Tool Error")
+        raise QueryValidationError(_("The query failed: {0}").format(str(e))) from e
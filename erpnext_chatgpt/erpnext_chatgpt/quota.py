@@ -0,0 +1,192 @@
+import frappe
+from frappe import _
+from frappe.utils import cint, get_datetime, getdate, add_days, nowdate
+import time
+from typing import Any, Dict, List, Optional
+
+# Limits are read from OpenAI Settings; a value of 0 disables the limit.
+SETTINGS_DOCTYPE = "OpenAI Settings"
+USAGE_RETENTION_DAYS = 35  # Keep daily usage counters around for the admin report
+
+# Atomically refill and take one token from every bucket in KEYS.
+# ARGV: now, then (capacity, refill_per_second) pairs in the same order as KEYS.
+# Either all buckets are charged or none are; on refusal the longest wait is returned.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 2])
+    local rate = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return {1, '0'}
+"""
+
+
+class QuotaExceededError(frappe.ValidationError):
+    """Raised when a user or the site has used up its OpenAI allowance."""
+
+    http_status_code = 429
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_limits() -> Dict[str, int]:
+    """Get the configured rate and token limits from OpenAI Settings."""
+    fields = (
+        "requests_per_minute_per_user",
+        "requests_per_minute_per_site",
+        "tokens_per_day_per_user",
+        "tokens_per_day_per_site",
+    )
+    return {field: cint(frappe.db.get_single_value(SETTINGS_DOCTYPE, field)) for field in fields}
+
+
+def _key(*parts: str) -> str:
+    return frappe.cache().make_key(":".join(("openai_quota",) + parts))
+
+
+def _usage_key(day: Optional[str] = None) -> str:
+    return _key("usage", str(getdate(day or nowdate())))
+
+
+def _seconds_until_tomorrow() -> int:
+    tomorrow = get_datetime(add_days(nowdate(), 1))
+    return max(1, int((tomorrow - get_datetime()).total_seconds()))
+
+
+def _take_request_tokens(user: str, limits: Dict[str, int]) -> None:
+    """Charge one request against the per-user and per-site token buckets."""
+    keys: List[str] = []
+    args: List[Any] = [time.time()]
+    for scope, per_minute in (
+        (f"user:{user}", limits["requests_per_minute_per_user"]),
+        ("site", limits["requests_per_minute_per_site"]),
+    ):
+        if per_minute > 0:
+            keys.append(_key("rpm", scope))
+            args.extend([per_minute, per_minute / 60.0])
+
+    if not keys:
+        return
+
+    cache = frappe.cache()
+    allowed, wait = cache.eval(TOKEN_BUCKET_SCRIPT, len(keys), *keys, *args)
+    if not cint(allowed):
+        retry_after = max(1, int(float(wait) + 0.999))
+        raise QuotaExceededError(
+            _("Too many requests. Please try again in {0} seconds.").format(retry_after),
+            retry_after,
+        )
+
+
+def _check_daily_tokens(user: str, limits: Dict[str, int]) -> None:
+    """Refuse the request if today's token allowance is already spent."""
+    user_limit = limits["tokens_per_day_per_user"]
+    site_limit = limits["tokens_per_day_per_site"]
+    if not user_limit and not site_limit:
+        return
+
+    pipe = frappe.cache().pipeline()
+    pipe.hget(_usage_key(), f"{user}:total_tokens")
+    pipe.hget(_usage_key(), "site:total_tokens")
+    user_used, site_used = (cint(value) for value in pipe.execute())
+
+    if user_limit and user_used >= user_limit:
+        message = _("You have used your daily OpenAI token allowance of {0}.").format(user_limit)
+    elif site_limit and site_used >= site_limit:
+        message = _("The daily OpenAI token allowance for this site has been used.")
+    else:
+        return
+    raise QuotaExceededError(message, _seconds_until_tomorrow())
+
+
+def check_quota(user: Optional[str] = None) -> None:
+    """
+    Check the rate and token limits for a user before calling OpenAI.
+
+    :param user: The user making the request, defaults to the session user.
+    :raises QuotaExceededError: If any limit has been reached.
+    """
+    user = user or frappe.session.user
+    limits = get_limits()
+    _check_daily_tokens(user, limits)
+    _take_request_tokens(user, limits)
+
+
+def record_usage(usage: Any, user: Optional[str] = None) -> None:
+    """
+    Add the token usage reported by OpenAI to today's counters.
+
+    :param usage: The `usage` object of a chat completion response.
+    :param user: The user making the request, defaults to the session user.
+    """
+    if not usage:
+        return
+    user = user or frappe.session.user
+    counts = {
+        "prompt_tokens": cint(getattr(usage, "prompt_tokens", 0)),
+        "completion_tokens": cint(getattr(usage, "completion_tokens", 0)),
+        "total_tokens": cint(getattr(usage, "total_tokens", 0)),
+    }
+
+    key = _usage_key()
+    pipe = frappe.cache().pipeline()
+    for scope in (user, "site"):
+        for field, count in counts.items():
+            pipe.hincrby(key, f"{scope}:{field}", count)
+    pipe.expire(key, USAGE_RETENTION_DAYS * 24 * 60 * 60)
+    pipe.execute()
+
+
+def record_request(user: Optional[str] = None) -> None:
+    """Count a request against today's usage, regardless of its outcome."""
+    user = user or frappe.session.user
+    key = _usage_key()
+    pipe = frappe.cache().pipeline()
+    pipe.hincrby(key, f"{user}:requests", 1)
+    pipe.hincrby(key, "site:requests", 1)
+    pipe.expire(key, USAGE_RETENTION_DAYS * 24 * 60 * 60)
+    pipe.execute()
+
+
+def get_usage(day: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Get the usage counters for a day, per user and for the whole site.
+
+    :param day: The date in YYYY-MM-DD format, defaults to today.
+    :return: Dictionary with the date, the site totals and a row per user.
+    """
+    key = _usage_key(day)
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(key)
+    (raw,) = pipe.execute()
+
+    totals: Dict[str, Dict[str, int]] = {}
+    for field, value in raw.items():
+        scope, _sep, metric = frappe.safe_decode(field).rpartition(":")
+        totals.setdefault(scope, {})[metric] = cint(value)
+
+    site = totals.pop("site", {})
+    users = [{"user": user, **counts} for user, counts in totals.items()]
+    users.sort(key=lambda row: row.get("total_tokens", 0), reverse=True)
+    return {"date": str(getdate(day or nowdate())), "site": site, "users": users}
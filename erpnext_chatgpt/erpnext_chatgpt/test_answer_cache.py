@@ -0,0 +1,37 @@
+import unittest
+
+from erpnext_chatgpt.erpnext_chatgpt.answer_cache import is_same_question, normalise_question
+
+
+class TestAnswerCacheMatching(unittest.TestCase):
+    def test_paraphrase_matches(self):
+        self.assertTrue(
+            is_same_question("Unpaid invoices this month", "show me the unpaid invoices for this month please")
+        )
+        self.assertTrue(is_same_question("list all clients", "show customers"))
+
+    def test_different_region_does_not_match(self):
+        self.assertFalse(
+            is_same_question(
+                "total sales for customer group retail in region east",
+                "total sales for customer group retail in region west",
+            )
+        )
+
+    def test_different_customer_group_does_not_match(self):
+        self.assertFalse(is_same_question("customers in group retail", "customers in group wholesale"))
+
+    def test_different_qualifier_does_not_match(self):
+        self.assertFalse(is_same_question("unpaid invoices this month", "unpaid invoices last month"))
+        self.assertFalse(is_same_question("unpaid invoices", "paid invoices"))
+
+    def test_different_record_does_not_match(self):
+        self.assertFalse(is_same_question("stock of item ITEM-001", "stock of item ITEM-002"))
+
+    def test_extra_word_does_not_match(self):
+        self.assertFalse(is_same_question("sales invoices", "overdue sales invoices"))
+        self.assertFalse(is_same_question("sales invoices", "sales invoices draft"))
+
+    def test_empty_question_does_not_match(self):
+        self.assertEqual(normalise_question("show me please"), "")
+        self.assertFalse(is_same_question("show me please", "please show me"))
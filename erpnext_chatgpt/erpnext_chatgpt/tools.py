@@ -2,6 +2,14 @@ import frappe
 import json
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+from erpnext_chatgpt.erpnext_chatgpt.deadline import run_sql
+from erpnext_chatgpt.erpnext_chatgpt.projection import summarise_document
+from erpnext_chatgpt.erpnext_chatgpt.query import (
+    DEFAULT_ROW_LIMIT,
+    MAX_ROW_LIMIT,
+    QueryValidationError,
+    run_query,
+)
 
 
 def json_serial(obj):
@@ -28,7 +36,7 @@ def get_sales_invoices(start_date=None, end_date=None):
         query += " WHERE posting_date BETWEEN %s AND %s"
         params.extend([start_date, end_date])
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 get_sales_invoices_tool = {
@@ -55,17 +63,18 @@ get_sales_invoices_tool = {
 
 
 def get_sales_invoice(invoice_number):
-    query = "SELECT * FROM `tabSales Invoice` WHERE name=%s"
-    return json.dumps(
-        frappe.db.sql(query, (invoice_number,), as_dict=True), default=json_serial
-    )
+    invoice = summarise_document("Sales Invoice", invoice_number)
+    if invoice is None:
+        return json.dumps({"error": f"Sales Invoice {invoice_number} not found"})
+    return json.dumps(invoice, default=json_serial)
 
 
 get_sales_invoice_tool = {
     "type": "function",
     "function": {
         "name": "get_sales_invoice",
-        "description": "Get a sales invoice by invoice number",
+        "description": "Get a sales invoice by invoice number, including its items and taxes. "
+        "Fields that are left out are empty or at their default; amounts that are left out are zero.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -93,7 +102,7 @@ def get_employees(department=None, designation=None):
     if filters:
         query += " WHERE " + " AND ".join(filters)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -133,7 +142,7 @@ def get_purchase_orders(start_date=None, end_date=None, supplier=None):
     if filters:
         query += " WHERE " + " AND ".join(filters)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -171,7 +180,7 @@ def get_customers(customer_group=None):
         query += " WHERE customer_group = %s"
         params.append(customer_group)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -201,7 +210,7 @@ def get_stock_levels(item_code=None):
         query += " WHERE item_code = %s"
         params.append(item_code)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -241,7 +250,7 @@ def get_general_ledger_entries(start_date=None, end_date=None, account=None):
         query += " WHERE " + " AND ".join(filters)
 
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -282,7 +291,7 @@ def get_balance_sheet(start_date, end_date):
         GROUP BY account
     """
     return json.dumps(
-        frappe.db.sql(query, (start_date, end_date), as_dict=True), default=json_serial
+        run_sql(query, (start_date, end_date), as_dict=True), default=json_serial
     )
 
 
@@ -363,7 +372,7 @@ def get_outstanding_invoices(customer=None):
         query += " AND customer = %s"
         params.append(customer)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -398,7 +407,7 @@ def get_sales_orders(start_date=None, end_date=None, customer=None):
     if filters:
         query += " WHERE " + " AND ".join(filters)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -442,7 +451,7 @@ def get_purchase_invoices(start_date=None, end_date=None, supplier=None):
     if filters:
         query += " WHERE " + " AND ".join(filters)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -481,7 +490,7 @@ def get_journal_entries(start_date=None, end_date=None):
         query += " WHERE posting_date BETWEEN %s AND %s"
         params.extend([start_date, end_date])
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -521,7 +530,7 @@ def get_payments(start_date=None, end_date=None, payment_type=None):
     if filters:
         query += " WHERE " + " AND ".join(filters)
     return json.dumps(
-        frappe.db.sql(query, tuple(params), as_dict=True), default=json_serial
+        run_sql(query, tuple(params), as_dict=True), default=json_serial
     )
 
 
@@ -552,6 +561,81 @@ get_payments_tool = {
 }
 
 
+def query_doctype(
+    doctype, fields=None, filters=None, group_by=None, order_by=None, limit=None
+):
+    try:
+        rows = run_query(doctype, fields, filters, group_by, order_by, limit)
+    except QueryValidationError as e:
+        return json.dumps({"error": str(e)})
+    return json.dumps(rows, default=json_serial)
+
+
+query_doctype_tool = {
+    "type": "function",
+    "function": {
+        "name": "query_doctype",
+        "description": (
+            "Run a read-only query on any ERPNext DocType the user can read. "
+            "Use it when no more specific function fits the question. "
+            f"Returns at most {MAX_ROW_LIMIT} rows, so aggregate with group_by for totals."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "doctype": {
+                    "type": "string",
+                    "description": "DocType name, e.g. Sales Invoice, Item, Customer",
+                },
+                "fields": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Fieldnames to return, or aggregates such as sum(grand_total) or count(*)",
+                },
+                "filters": {
+                    "type": "array",
+                    "description": "Conditions that must all match",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "field": {"type": "string", "description": "Fieldname"},
+                            "operator": {
+                                "type": "string",
+                                "enum": [
+                                    "=", "!=", ">", ">=", "<", "<=", "like",
+                                    "not like", "in", "not in", "between", "is",
+                                ],
+                            },
+                            "value": {
+                                "type": ["string", "number", "array"],
+                                "items": {"type": ["string", "number"]},
+                                "description": "A list for in, not in and between; 'set' or 'not set' for is",
+                            },
+                        },
+                        "required": ["field", "operator", "value"],
+                    },
+                },
+                "group_by": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Fieldnames to group by",
+                },
+                "order_by": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Fields or aggregates with an optional direction, e.g. posting_date desc",
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": f"Maximum number of rows, defaults to {DEFAULT_ROW_LIMIT}",
+                },
+            },
+            "required": ["doctype", "fields"],
+        },
+    },
+}
+
+
 def get_tools():
     return [
         get_sales_invoices_tool,
@@ -568,6 +652,7 @@ def get_tools():
         get_purchase_invoices_tool,
         get_journal_entries_tool,
         get_payments_tool,
+        query_doctype_tool,
     ]
 
 
@@ -586,4 +671,38 @@ available_functions = {
     "get_purchase_invoices": get_purchase_invoices,
     "get_journal_entries": get_journal_entries,
     "get_payments": get_payments,
+    "query_doctype": query_doctype,
 }
+
+
+# DocTypes whose changes can change the result of each function
+tool_doctypes = {
+    "get_sales_invoices": ["Sales Invoice"],
+    "get_sales_invoice": ["Sales Invoice"],
+    "get_employees": ["Employee"],
+    "get_purchase_orders": ["Purchase Order"],
+    "get_customers": ["Customer"],
+    "get_stock_levels": ["Bin", "Stock Ledger Entry"],
+    "get_general_ledger_entries": ["GL Entry"],
+    "get_balance_sheet": ["GL Entry"],
+    "get_profit_and_loss_statement": ["GL Entry"],
+    # Journal Entries and payment ledger postings update outstanding_amount with db_set,
+    # which fires no Sales Invoice events
+    "get_outstanding_invoices": ["Sales Invoice", "Payment Entry", "Journal Entry", "Payment Ledger Entry"],
+    "get_sales_orders": ["Sales Order"],
+    "get_purchase_invoices": ["Purchase Invoice"],
+    "get_journal_entries": ["Journal Entry"],
+    "get_payments": ["Payment Entry"],
+}
+
+
+# Functions whose results depend on the asking user: query_doctype applies owner-only
+# permissions and shared documents, get_profit_and_loss_statement the user's default company
+user_dependent_tools = {"query_doctype", "get_profit_and_loss_statement"}
+
+
+def get_tool_doctypes(function_name, function_args):
+    if function_name == "query_doctype":
+        doctype = function_args.get("doctype")
+        return [str(doctype)] if doctype else []
+    return tool_doctypes.get(function_name, [])
@@ -8,11 +8,21 @@ app_email = "williamluke4@gmail.com"
 app_license = "MIT"
 
 # Include JS and CSS files in header of desk.html
-app_include_js = "/assets/erpnext_chatgpt/js/frontend.js?v=7"
+app_include_js = "/assets/erpnext_chatgpt/js/frontend.js?v=11"
 
 # Doctype JavaScript
 doctype_js = {
     "OpenAI Settings": "erpnext_chatgpt/doctype/openai_settings/openai_settings.js"
 }
 
+doc_events = {
+    "*": {
+        "on_update": "erpnext_chatgpt.erpnext_chatgpt.answer_cache.bump_data_version",
+        "on_submit": "erpnext_chatgpt.erpnext_chatgpt.answer_cache.bump_data_version",
+        "on_cancel": "erpnext_chatgpt.erpnext_chatgpt.answer_cache.bump_data_version",
+        "on_update_after_submit": "erpnext_chatgpt.erpnext_chatgpt.answer_cache.bump_data_version",
+        "on_trash": "erpnext_chatgpt.erpnext_chatgpt.answer_cache.bump_data_version",
+    }
+}
+
 fixtures = [{"dt": "DocType", "filters": [["name", "in", ["OpenAI Settings"]]]}]
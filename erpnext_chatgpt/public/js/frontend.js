@@ -3,6 +3,26 @@ document.addEventListener("DOMContentLoaded", initializeChat);
 
 let currentSessionIndex = null;
 
+// In-memory copy of the sessions stored in localStorage, written back debounced
+let sessionsCache = null;
+let saveSessionsTimer = null;
+const SAVE_SESSIONS_DELAY = 500; // ms
+
+// Incremental rendering state for the #answer container
+let renderedContainer = null;
+let renderedConversation = null;
+let renderedMessageCount = 0;
+const renderedHtmlCache = new WeakMap();
+
+// Older messages longer than this are collapsed and only rendered when expanded.
+// Collapsed objects keep their content here by id until they are first expanded.
+const LARGE_MESSAGE_LENGTH = 5000;
+const pendingRenders = new Map();
+let nextPendingRenderId = 0;
+
+window.addEventListener("beforeunload", flushSessions);
+window.addEventListener("storage", handleSessionsChanged);
+
 async function initializeChat() {
   await loadMarkedJs();
   await loadDompurify();
@@ -107,8 +127,47 @@ function handleAskButtonClick() {
   askQuestion(question).finally(() => (input.value = ""));
 }
 
+function getSessions() {
+  if (sessionsCache === null) {
+    sessionsCache = JSON.parse(localStorage.getItem("sessions")) || [];
+  }
+  return sessionsCache;
+}
+
+function saveSessions() {
+  clearTimeout(saveSessionsTimer);
+  saveSessionsTimer = setTimeout(flushSessions, SAVE_SESSIONS_DELAY);
+}
+
+function flushSessions() {
+  clearTimeout(saveSessionsTimer);
+  saveSessionsTimer = null;
+  if (sessionsCache !== null) {
+    localStorage.setItem("sessions", JSON.stringify(sessionsCache));
+  }
+}
+
+function handleSessionsChanged(event) {
+  // Another tab saved its sessions; drop our copy so we don't overwrite theirs.
+  // A write of our own that is still pending wins, as it is the most recent.
+  if (event.key !== null && event.key !== "sessions") return;
+  if (saveSessionsTimer !== null) return;
+
+  sessionsCache = null;
+  if (!document.getElementById("sessions-list")) return;
+  loadSessions();
+  const session =
+    currentSessionIndex === null ? null : getSessions()[currentSessionIndex];
+  if (session) {
+    displayConversation(session.conversation);
+  } else {
+    currentSessionIndex = null;
+    clearConversation();
+  }
+}
+
 function loadSessions() {
-  const sessions = JSON.parse(localStorage.getItem("sessions")) || [];
+  const sessions = getSessions();
   const sessionsList = document.getElementById("sessions-list");
 
   sessionsList.innerHTML = "";
@@ -121,8 +180,7 @@ function loadSessions() {
 
 function loadSession(index) {
   currentSessionIndex = index;
-  const sessions = JSON.parse(localStorage.getItem("sessions")) || [];
-  const session = sessions[index];
+  const session = getSessions()[index];
   if (session) {
     displayConversation(session.conversation);
   }
@@ -142,22 +200,22 @@ function createSessionListItem(session, index) {
 
 function deleteSession(event, index) {
   event.stopPropagation();
-  const sessions = JSON.parse(localStorage.getItem("sessions")) || [];
+  const sessions = getSessions();
   sessions.splice(index, 1);
-  localStorage.setItem("sessions", JSON.stringify(sessions));
+  saveSessions();
   loadSessions();
   if (index === currentSessionIndex) {
     currentSessionIndex = null;
-    document.getElementById("answer").innerHTML = "";
+    clearConversation();
   }
 }
 
 function createSession() {
   const sessionName = prompt("Enter session name:");
   if (sessionName) {
-    const sessions = JSON.parse(localStorage.getItem("sessions")) || [];
+    const sessions = getSessions();
     sessions.push({ name: sessionName, conversation: [] });
-    localStorage.setItem("sessions", JSON.stringify(sessions));
+    saveSessions();
     loadSessions();
     currentSessionIndex = sessions.length - 1;
   }
@@ -169,9 +227,9 @@ async function askQuestion(question) {
     return;
   }
 
-  const sessions = JSON.parse(localStorage.getItem("sessions")) || [];
-  let conversation = sessions[currentSessionIndex].conversation;
-  conversation.push({ role: "user", content: question });
+  const sessionIndex = currentSessionIndex;
+  const conversation = getSessions()[sessionIndex].conversation;
+  const userMessage = { role: "user", content: question };
 
   try {
     const response = await fetch(
@@ -182,10 +240,15 @@ async function askQuestion(question) {
           "Content-Type": "application/json",
           "X-Frappe-CSRF-Token": frappe.csrf_token,
         },
-        body: JSON.stringify({ conversation }),
+        body: JSON.stringify({ conversation: [...conversation, userMessage] }),
       }
     );
 
+    if (response.status === 429) {
+      const data = await response.json();
+      throw new Error(data?.message?.error || "Too many requests");
+    }
+
     if (!response.ok) {
       throw new Error(`HTTP error! status: ${response.status}`);
     }
@@ -194,12 +257,20 @@ async function askQuestion(question) {
     console.log("API response:", data);
 
     const messageContent = parseResponseMessage(data);
-    conversation.push({ role: "assistant", content: messageContent });
-    sessions[currentSessionIndex].conversation = conversation;
-    localStorage.setItem("sessions", JSON.stringify(sessions));
-    displayConversation(conversation);
+    // Sessions may have been reloaded from another tab while we waited
+    const session = getSessions()[sessionIndex];
+    if (!session) return;
+    session.conversation.push(userMessage, {
+      role: "assistant",
+      content: messageContent,
+    });
+    saveSessions();
+    if (currentSessionIndex === sessionIndex) {
+      displayConversation(session.conversation);
+    }
   } catch (error) {
     console.error("Error in askQuestion:", error);
+    clearConversation();
     document.getElementById("answer").innerHTML = `
       <div class="alert alert-danger" role="alert">
         Error: ${error.message}. Please try again later.
@@ -243,29 +314,93 @@ function parseResponseMessage(response) {
   return JSON.stringify(message, null, 2);
 }
 
+function clearConversation() {
+  const conversationContainer = document.getElementById("answer");
+  if (conversationContainer) conversationContainer.innerHTML = "";
+  renderedConversation = null;
+  renderedMessageCount = 0;
+  pendingRenders.clear();
+}
+
 function displayConversation(conversation) {
   const conversationContainer = document.getElementById("answer");
-  conversationContainer.innerHTML = "";
-
-  conversation.forEach((message) => {
-    const messageElement = document.createElement("div");
-    messageElement.className =
-      message.role === "user" ? "alert alert-info" : "alert alert-secondary";
-    messageElement.innerHTML = renderMessageContent(message.content);
-    conversationContainer.appendChild(messageElement);
+
+  // Only append the messages added since the last render of this conversation
+  if (
+    conversationContainer !== renderedContainer ||
+    conversation !== renderedConversation ||
+    conversation.length < renderedMessageCount
+  ) {
+    clearConversation();
+    renderedContainer = conversationContainer;
+    renderedConversation = conversation;
+  }
+
+  // The newest message is the answer the user is waiting for, so it is always rendered in full
+  const fragment = document.createDocumentFragment();
+  const newestIndex = conversation.length - 1;
+  conversation.slice(renderedMessageCount).forEach((message, offset) => {
+    const isNewest = renderedMessageCount + offset === newestIndex;
+    fragment.appendChild(createMessageElement(message, isNewest));
   });
+  conversationContainer.appendChild(fragment);
+  renderedMessageCount = conversation.length;
 }
 
-function renderMessageContent(content) {
-  console.log("Rendering content:", content);
+function createMessageElement(message, eager) {
+  const messageElement = document.createElement("div");
+  messageElement.className =
+    message.role === "user" ? "alert alert-info" : "alert alert-secondary";
+  if (eager || !isLargeContent(message.content)) {
+    messageElement.innerHTML = renderMessage(message);
+  } else {
+    messageElement.appendChild(createDeferredButton(messageElement, message));
+  }
+  return messageElement;
+}
+
+function renderMessage(message) {
+  // Only the sanitised markdown is memoised; objects are cheap to render because
+  // their entries are rendered lazily, and their ids are pruned with each re-render
+  if (typeof message.content !== "string") {
+    return renderMessageContent(message.content);
+  }
+  let html = renderedHtmlCache.get(message);
+  if (html === undefined) {
+    html = renderMessageContent(message.content);
+    renderedHtmlCache.set(message, html);
+  }
+  return html;
+}
+
+function isLargeContent(content) {
+  if (content === null || typeof content !== "object") {
+    return typeof content === "string" && content.length > LARGE_MESSAGE_LENGTH;
+  }
+  return JSON.stringify(content).length > LARGE_MESSAGE_LENGTH;
+}
+
+function createDeferredButton(messageElement, message) {
+  const content = message.content;
+  const size = Math.ceil(
+    (typeof content === "string" ? content : JSON.stringify(content)).length /
+      1024
+  );
+  const button = document.createElement("button");
+  button.className = "btn btn-sm btn-secondary";
+  button.innerText = `Show full message (${size} KB)`;
+  button.addEventListener("click", () => {
+    messageElement.innerHTML = renderMessage(message);
+  });
+  return button;
+}
 
+function renderMessageContent(content) {
   if (content === null) return "<em>null</em>";
   if (typeof content === "boolean") return `<strong>${content}</strong>`;
   if (typeof content === "number") return `<span>${content}</span>`;
   if (typeof content === "string") {
-    const parsed = DOMPurify.sanitize(marked.parse(content));
-    console.log(parsed);
-    return parsed;
+    return DOMPurify.sanitize(marked.parse(content));
   }
   if (Array.isArray(content)) {
     return `<ul class="list-group">${content
@@ -281,24 +416,35 @@ function renderMessageContent(content) {
 }
 
 function renderCollapsibleObject(object) {
-  const objectEntries = Object.entries(object)
-    .map(
-      ([key, value]) =>
-        `<div><strong>${key}:</strong> ${renderMessageContent(value)}</div>`
-    )
-    .join("");
+  // The entries are rendered the first time the object is expanded
+  const id = nextPendingRenderId++;
+  pendingRenders.set(id, object);
   return `
     <div class="collapsible-object">
-      <button class="btn btn-sm btn-secondary" onclick="toggleCollapse(this)">Toggle Object</button>
-      <div class="object-content" style="display: none; padding-left: 15px;">
-        ${objectEntries}
-      </div>
+      <button class="btn btn-sm btn-secondary" data-render-id="${id}" onclick="toggleCollapse(this)">Toggle Object</button>
+      <div class="object-content" style="display: none; padding-left: 15px;"></div>
     </div>
   `;
 }
 
+function renderObjectEntries(object) {
+  return Object.entries(object)
+    .map(
+      ([key, value]) =>
+        `<div><strong>${escapeHTML(key)}:</strong> ${renderMessageContent(
+          value
+        )}</div>`
+    )
+    .join("");
+}
+
 function toggleCollapse(button) {
   const content = button.nextElementSibling;
+  const id = Number(button.dataset.renderId);
+  if (pendingRenders.has(id)) {
+    content.innerHTML = renderObjectEntries(pendingRenders.get(id));
+    pendingRenders.delete(id);
+  }
   content.style.display = content.style.display === "none" ? "block" : "none";
 }
 